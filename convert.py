@@ -7,7 +7,47 @@ import base64
 import gzip
 import re
 import argparse
-from xml.etree import cElementTree as ElementTree
+import calendar
+import time
+import functools
+import collections
+import concurrent.futures
+try:
+    # Faster, and can skip straight to the <page> elements
+    from lxml import etree as ElementTree
+    LXML = True
+except ImportError:
+    from xml.etree import ElementTree
+    LXML = False
+
+# Marker paragraph put between the pages converted in a single pandoc call
+PANDOC_SENTINEL = "CD985272F78311"
+PANDOC_BATCH_SIZE = 50
+# Warnings pandoc prints on every run, e.g. markdown_github being deprecated
+_PANDOC_NOISE_RE = re.compile(r'^\[WARNING\] Deprecated: .*\n?', re.MULTILINE)
+
+# Markdown links from pandoc like ...](URL "wikilink")... see cleanup_markdown
+# allowing for balanced parentheses in the URL, e.g. Foo_(bar)
+_WIKILINK_RE = re.compile(r'\]\((?P<url>[A-Z](?:[^()"\n]|\([^()"\n]*\))*) "wikilink"\)')
+# Category and user page links to escape for pandoc, see cleanup_mediawiki
+_NAMESPACE_LINK_RE = re.compile(r'\[\[(?::(Category)|(User)):')
+_CATEGORY_RE = re.compile(r'\[\[Category:([^\]]+)\]\]')
+# Whole page is just a redirect, allowing for stray LEFT-TO-RIGHT marks and
+# any category tags after it (which cleanup_mediawiki would have removed)
+_REDIRECT_RE = re.compile(r'^[\s\u200e]*#REDIRECT\s*\[\[([^\]\n]+)\]\]'
+                          r'(?:[\s\u200e]|\[\[Category:[^\]\n]*\]\])*\Z')
+# Second column of the user table, name <email>
+_AUTHOR_RE = re.compile(r'^[^<]+ <[^@>]+@[^>]+>$')
+# Spaces/colons/slashes to underscores for filenames, see make_filename
+_FILENAME_TRANS = str.maketrans({" ": "_", ":": "_", "/": "_"})
+# Characters to remove entirely, currently just LEFT-TO-RIGHT MARK
+_LTR = "\u200e"
+_ZAP = str.maketrans("", "", _LTR)
+# Language specific tags like <python> to turn into <source lang=python>
+_LANGUAGES = "python|perl|sql|bash|ruby|java|xml"
+_LANG_OPEN_RE = re.compile(r'^<(%s)>(.*)$' % _LANGUAGES, re.IGNORECASE | re.MULTILINE)
+_LANG_OPEN_ATTR_RE = re.compile(r'^<(%s) (?=.*>)' % _LANGUAGES, re.MULTILINE)
+_LANG_CLOSE_RE = re.compile(r'^(.*)</(%s)>[ \t\r]*$' % _LANGUAGES, re.MULTILINE)
 
 
 def main():
@@ -32,16 +72,19 @@ def main():
     parser.add_argument('--default_layout', default="wiki")  # Can also use None; note get tagpage for category listings
     parser.add_argument('--git', default="git")  # assume on path
     parser.add_argument('--pandoc', default="pandoc")  # assume on path
+    parser.add_argument('--jobs', type=positive_int, default=os.cpu_count() or 1)  # parallel pandoc conversions
 
     args = parser.parse_args()
 
-    page_prefixes_to_ignore = ["Help:", "MediaWiki:", "Talk:", "User:", "User talk:"]  # Beware spaces vs _
+    page_prefixes_to_ignore = ("Help:", "MediaWiki:", "Talk:", "User:", "User talk:")  # Beware spaces vs _
 
     # is pandoc present?
     check_pandoc(args.pandoc)
 
     # are we in a repo?
     assert os.path.isdir(".git"), "Expected to be in a Git repository!"
+    # and able to commit to a branch? Check before the slow XML parsing.
+    branch = check_git(args.git)
 
     # make prefix dir if necessary
     if args.prefix:
@@ -51,19 +94,28 @@ def main():
 
     user_mapping = make_user_mapping(args.user_table)
     blocklist = make_blocklist(args.user_blocklist)
-    (xml_handle, tree) = parse_xml(args.mediawiki_xml_dump)
-    cursor = create_db(args.mediawiki_xml_dump)
-
-    # don't do this in main()
-    run_tests()
-
-    extract_revisions(tree, cursor, blocklist, page_prefixes_to_ignore)
+    (xml_handle, pages) = parse_xml(args.mediawiki_xml_dump)
+    conn = create_db(args.mediawiki_xml_dump)
+    cursor = conn.cursor()
+
+    # Case variants of titles are only a problem on case insensitive file
+    # systems (e.g. Windows, or default Mac OS X), so don't check on Linux.
+    case_map = None if sys.platform.startswith("linux") else {}
+
+    # One explicit transaction for the whole XML walk, rather than
+    # letting SQLite commit (and sync) after every single revision.
+    cursor.execute("BEGIN")
+    extract_revisions(pages, cursor, blocklist, page_prefixes_to_ignore, case_map)
+    cursor.execute("COMMIT")
     xml_handle.close()
 
-    # no-op on linux box
-    check_for_name_collisions(cursor, page_prefixes_to_ignore)
+    # Bulk load first, then index, so commit_revisions can walk the
+    # revisions in date order straight off the index, without sorting.
+    cursor.execute("CREATE INDEX idx_rev_date_title ON revisions (date, title)")
 
-    missing_users = commit_revisions(cursor, user_mapping, page_prefixes_to_ignore, args, {})
+    importer = start_fast_import(args, branch)
+    missing_users = commit_revisions(cursor, user_mapping, page_prefixes_to_ignore, args, {}, importer)
+    finish_fast_import(importer, args)
 
     print("=" * 60)
     if missing_users:
@@ -73,19 +125,27 @@ def main():
 
     # not sure how effective this is on its own...
     # print("Removing any empty commits...")
-    # run("%s filter-branch --prune-empty -f HEAD" % args.git)
-    # so replace it up with these, per https://stackoverflow.com/a/28720432
-    run("%s gc" % args.git)
-    run("%s repack -Ad" % args.git)
-    run("%s prune" % args.git)
+    # run([args.git, "filter-branch", "--prune-empty", "-f", "HEAD"])
+    # so replace it up with a gc, repack and prune, per https://stackoverflow.com/a/28720432
+    # which a single aggressive gc will do for us:
+    run([args.git, "gc", "--aggressive", "--prune=now"])
     print("Done")
 
 
-def commit_revisions(cursor, user_mapping, page_prefixes_to_ignore, args, missing_users):
+def positive_int(value):
+    """Command line argument type for a whole number, at least one."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, not %s" % value)
+    return number
+
+
+def commit_revisions(cursor, user_mapping, page_prefixes_to_ignore, args, missing_users, importer):
     print("=" * 60)
     print("Sorting changes by revision date...")
-    for title, filename, date, username, text, comment in \
-            cursor.execute('SELECT * FROM revisions ORDER BY date, title'):
+    for (title, filename, date, username, text, comment), converted in \
+            convert_revisions(cursor.execute('SELECT * FROM revisions ORDER BY date, title'),
+                              page_prefixes_to_ignore, args):
         if filename:
             filename = os.path.join(args.prefix, filename)
         if text is None:
@@ -97,8 +157,8 @@ def commit_revisions(cursor, user_mapping, page_prefixes_to_ignore, args, missin
         if title.startswith("File:"):
             # Example Title File:Wininst.png
             # TODO - capture the preferred filename from the XML!
-            missing_users = \
-                commit_file(title, filename, date, username, text, comment, user_mapping, args, missing_users)
+            missing_users = commit_file(
+                title, filename, date, username, text, comment, user_mapping, args, missing_users, importer)
             continue
         if title.startswith("Template:"):
             # Can't handle these properly (yet)
@@ -110,52 +170,93 @@ def commit_revisions(cursor, user_mapping, page_prefixes_to_ignore, args, missin
         md_filename = make_filename(title, args.markdown_ext, args.prefix)
         mw_filename = make_filename(title, args.mediawiki_ext, args.prefix)
         print("Converting %s as of revision %s by %s" % (md_filename, date, username))
-        if dump_revision(mw_filename, md_filename, text, title, args, date):
+        if dump_revision(mw_filename, md_filename, text, title, args, date, converted):
             missing_users = commit_revision(
-                mw_filename, md_filename, username, date, comment, user_mapping, args, missing_users)
+                mw_filename, md_filename, username, date, comment, user_mapping, args, missing_users, importer)
         else:
             # Only the mediawiki changed, could not convert to markdown.
-            cmd = "{0} reset --hard".format(args.git)
-            run(cmd)
+            # Nothing was sent to git, and the working tree is reset at the end.
             sys.stderr.write("Skipping this revision!\n")
     return missing_users
 
 
-def check_for_name_collisions(cursor, page_prefixes_to_ignore):
-    if sys.platform != "linux2":
-        names = dict()
-        for title, in cursor.execute('SELECT DISTINCT title FROM revisions ORDER BY title'):
-            if ignore_by_prefix(title, page_prefixes_to_ignore):
-                assert False, "Should have already excluded %s?" % title
-                pass
-            elif title.lower() not in names:
-                names[title.lower()] = title
-            else:
-                if names[title.lower()] != title:
-                    print("WARNING: Multiple case variants exist, e.g.")
-                    print(" - " + title)
-                    print(" - " + names[title.lower()])
-                    print("If your file system cannot support such filenames at the same time")
-                    print("(e.g. Windows, or default Mac OS X) this conversion will FAIL.")
-                    break
-
-
-def run_tests():
-    # move these to a test module
-    tmp = \
-        '<div style="float:left; maxwidth: 180px; margin-left:25px; margin-right:15px; background-color: #FFFFFF">' \
-        '[[Image:Pear.png|left|The Bosc Pear]]</div>'
-    assert un_div(tmp) == '[[Image:Pear.png|left|The Bosc Pear]]', un_div(tmp)
-    del tmp
-
-    tmp = \
-        '<div style="float:left; maxwidth: 180px; margin-left:25px; margin-right:15px; background-color: #FFFFFF">' \
-        '[[Image:Pear.png|left|The Bosc Pear]]</div>'
-    assert cleanup_mediawiki(tmp) == ('[[Image:Pear.png|left|The Bosc Pear]]', []), cleanup_mediawiki(tmp)
-    del tmp
-
-
-def extract_revisions(tree, cursor, blocklist, page_prefixes_to_ignore):
+def convert_revisions(rows, page_prefixes_to_ignore, args):
+    """Pair up each revision row with its conversion to markdown.
+
+    Yields (row, converted) tuples in the same order as the rows given,
+    where converted is None unless the row is a wiki page revision (see
+    is_wiki_page), otherwise a tuple of the page categories, any redirect
+    target, and the (stdout, stderr, return code) from pandoc (or None
+    for a redirect).
+
+    The rows are fetched in batches, with all the wiki pages in a batch
+    converted together to save on pandoc start up costs (see convert_batch),
+    and several batches converted in parallel ahead of the git commits.
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        # Only read a few batches ahead, rather than the entire database
+        pending = collections.deque()
+        batch = rows.fetchmany(PANDOC_BATCH_SIZE)
+        while batch or pending:
+            if batch:
+                # Only send the wiki page text to the worker, not uploads etc
+                texts = [row[4] for row in batch if is_wiki_page(row[0], page_prefixes_to_ignore)]
+                pending.append((batch, executor.submit(convert_batch, texts, args.pandoc)))
+                batch = rows.fetchmany(PANDOC_BATCH_SIZE)
+            if not batch or len(pending) > 2 * args.jobs:
+                done, future = pending.popleft()
+                converted = iter(future.result())
+                for row in done:
+                    if is_wiki_page(row[0], page_prefixes_to_ignore):
+                        yield row, next(converted)
+                    else:
+                        yield row, None
+
+
+def convert_batch(texts, pandoc):
+    """Convert a batch of wiki page texts, see convert_revisions.
+
+    Runs in a worker process, so must not touch the git working tree.
+    """
+    pages = []
+    for text in texts:
+        # Redirects are common, and need neither cleaning up nor pandoc
+        redirect = get_redirect(text)
+        if redirect:
+            pages.append((None, [], redirect))
+        else:
+            text, categories = cleanup_mediawiki(text)
+            pages.append((text, categories, None))
+    markdown = iter(run_pandoc_batch(pandoc, [page[0] for page in pages if not page[2]]))
+    converted = []
+    for text, categories, redirect in pages:
+        if redirect:
+            converted.append((categories, redirect, None))
+        else:
+            converted.append((categories, None, next(markdown)))
+    return converted
+
+
+def check_name_collision(title, case_map):
+    """Warn if title only differs by case from one already recorded.
+
+    The case_map is a dict of lower case titles to the title seen, or
+    None to skip this check.
+    """
+    if case_map is None:
+        return
+    prior = case_map.setdefault(title.lower(), title)
+    if prior != title:
+        print("WARNING: Multiple case variants exist, e.g.")
+        print(" - " + title)
+        print(" - " + prior)
+        print("If your file system cannot support such filenames at the same time")
+        print("(e.g. Windows, or default Mac OS X) this conversion will FAIL.")
+        # Only warn once per page, not for every revision
+        case_map[title.lower()] = title
+
+
+def extract_revisions(pages, cursor, blocklist, page_prefixes_to_ignore, case_map):
 
     print("=" * 60)
     print("Parsing XML and saving revisions by page.")
@@ -166,119 +267,163 @@ def extract_revisions(tree, cursor, blocklist, page_prefixes_to_ignore):
     comment = None
     username = None
     text = None
-    for event, element in tree:
+    for element in iter_end(pages):
         tag = clean_tag(element.tag)
-        if event == "start":
-            if tag == "page":
-                assert title is None, title
-                assert date is None, date
-            if tag == "revision" or tag == "upload":
-                assert date is None, "%r for %r" % (date, title)
-            if tag == "contents":
-                assert element.attrib["encoding"] == "base64"
-        elif event == "end":
-            if tag == "title":
-                title = element.text.strip()
-            elif tag == "timestamp":
-                date = element.text.strip()
-            elif tag == "comment":
-                if element.text is not None:
-                    comment = element.text.strip()
-            elif tag == "username":
-                username = element.text.strip()
-            elif tag == "text":
-                text = element.text
-            elif tag == "contents":
-                # Used in uploads
-                text = element.text.strip()
-            elif tag == "filename":
-                # Expected in uploads
-                filename = element.text.strip()
-            elif tag == "revision":
-                if username is None:
-                    username = ""
-                if comment is None:
-                    comment = ""
-                if username not in blocklist:
-                    if title.startswith("File:"):
-                        # print("Ignoring revision for %s in favour of upload entry" % title)
-                        pass
-                    elif ignore_by_prefix(title, page_prefixes_to_ignore):
-                        # print("Ignoring revision for %s due to title prefix" % title)
-                        pass
-                    elif text is not None:
-                        # print("Recording '%s' as of revision %s by %s" % (title, date, username))
-                        cursor.execute("INSERT INTO revisions VALUES (?, ?, ?, ?, ?, ?)",
-                                       (title, filename, date, username, text, comment))
-                filename = date = username = text = comment = None
-            elif tag == "upload":
-                assert title.startswith("File:")
-                # Want to treat like a revision?
-                if username is None:
-                    username = ""
-                if comment is None:
-                    comment = ""
-                if username not in blocklist:
-                    if text is not None or title.startswith("File:"):
-                        # print("Recording '%s' as of upload %s by %s" % (title, date, username))
-                        cursor.execute("INSERT INTO revisions VALUES (?, ?, ?, ?, ?, ?)",
-                                       (title, filename, date, username, text, comment))
-                filename = date = username = text = comment = None
-            elif tag == "page":
-                assert date is None, date
-                title = filename = date = username = text = comment = None
-        else:
-            sys.exit("Unexpected event %r with element %r" % (event, element))
+        if tag == "title":
+            title = element.text.strip()
+        elif tag == "timestamp":
+            date = element.text.strip()
+        elif tag == "comment":
+            if element.text is not None:
+                comment = element.text.strip()
+        elif tag == "username":
+            username = element.text.strip()
+        elif tag == "text":
+            text = element.text
+        elif tag == "contents":
+            # Used in uploads
+            assert element.attrib["encoding"] == "base64"
+            text = element.text.strip()
+        elif tag == "filename":
+            # Expected in uploads
+            filename = element.text.strip()
+        elif tag == "revision":
+            if username is None:
+                username = ""
+            if comment is None:
+                comment = ""
+            if username not in blocklist:
+                if title.startswith("File:"):
+                    # print("Ignoring revision for %s in favour of upload entry" % title)
+                    pass
+                elif ignore_by_prefix(title, page_prefixes_to_ignore):
+                    # print("Ignoring revision for %s due to title prefix" % title)
+                    pass
+                elif text is not None:
+                    # print("Recording '%s' as of revision %s by %s" % (title, date, username))
+                    check_name_collision(title, case_map)
+                    cursor.execute("INSERT INTO revisions VALUES (?, ?, ?, ?, ?, ?)",
+                                   (title, filename, date, username, text, comment))
+            filename = date = username = text = comment = None
+            # Done with this revision, free the memory.
+            element.clear()
+        elif tag == "upload":
+            assert title.startswith("File:")
+            # Want to treat like a revision?
+            if username is None:
+                username = ""
+            if comment is None:
+                comment = ""
+            if username not in blocklist:
+                if text is not None or title.startswith("File:"):
+                    # print("Recording '%s' as of upload %s by %s" % (title, date, username))
+                    check_name_collision(title, case_map)
+                    cursor.execute("INSERT INTO revisions VALUES (?, ?, ?, ?, ?, ?)",
+                                   (title, filename, date, username, text, comment))
+            filename = date = username = text = comment = None
+            # Done with this upload, free the memory.
+            element.clear()
+        elif tag == "page":
+            assert date is None, date
+            title = filename = date = username = text = comment = None
+            # Otherwise iterparse would keep the entire dump in memory
+            element.clear()
+            if LXML:
+                # Can also drop the earlier (already cleared) pages,
+                # which without lxml is done in _iter_pages instead
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+
+def iter_end(pages):
+    """Walk the <page> elements in the same order as iterparse end events."""
+    for page in pages:
+        for element in _iter_end(page):
+            yield element
+
+
+def _iter_end(element):
+    for child in element:
+        if isinstance(child.tag, str):
+            # i.e. not an XML comment or processing instruction
+            for sub_element in _iter_end(child):
+                yield sub_element
+    yield element
 
 
 def create_db(mediawiki_xml_dump):
     db = mediawiki_xml_dump + ".sqlite"
     if os.path.isfile(db):
         os.remove(db)
-    conn = sqlite3.connect(db)
+    # Manage transactions explicitly (see main), and since this is a
+    # throw-away working copy of the XML dump, trade durability for speed:
+    conn = sqlite3.connect(db, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA temp_store=MEMORY")
     c = conn.cursor()
     # Going to use this same table for BOTH plain text revisions to pages
     # AND for base64 encoded uploads for file attachments, because want
     # to sort both by date and turn each into a commit.
     c.execute("CREATE TABLE revisions "
               "(title text, filename text, date text, username text, content text, comment text)")
-    return c
+    return conn
 
 
 def parse_xml(mediawiki_xml_dump):
+    """Returns the open file handle, and an iterator over the <page> elements."""
     if mediawiki_xml_dump.endswith(".gz"):
         xml_handle = gzip.open(mediawiki_xml_dump)
     else:
-        xml_handle = open(mediawiki_xml_dump)
-    return xml_handle, ElementTree.iterparse(xml_handle, events=('start', 'end'))
+        xml_handle = open(mediawiki_xml_dump, "rb")
+    if LXML:
+        tree = ElementTree.iterparse(xml_handle, events=('end',), tag='{*}page',
+                                     huge_tree=True, remove_blank_text=True)
+        return xml_handle, (element for event, element in tree)
+    # Want the start events only to get hold of the root element
+    tree = ElementTree.iterparse(xml_handle, events=('start', 'end'))
+    return xml_handle, _iter_pages(tree)
+
+
+def _iter_pages(tree):
+    """Yield the <page> end events, and remove each page from the root after use."""
+    root = None
+    for event, element in tree:
+        if root is None:
+            # The first start event is for the root <mediawiki> element
+            root = element
+        elif event == "end" and clean_tag(element.tag) == "page":
+            yield element
+            # No parent pointers in ElementTree, but all we have left
+            # under the root are the pages already used:
+            root.clear()
 
 
 def make_blocklist(user_blocklist):
-    blocklist = set()
-    with open(user_blocklist, "r") as handle:
-        for line in handle:
-            blocklist.add(line.strip())
-    return blocklist
+    with open(user_blocklist, "r", encoding="utf-8") as handle:
+        lines = handle.read().splitlines()
+    # Ignore blank lines, which would otherwise block all anonymous edits
+    return {line.strip() for line in lines if line.strip()}
 
 
 def make_user_mapping(user_table):
     user_mapping = dict()
-    with open(user_table, "r") as handle:
-        for line in handle:
-            if not line.strip():
-                continue
-            try:
-                username, github = line.strip().split("\t")
-            except ValueError:
-                sys.stderr.write("Invalid entry in %s: %s" % (user_table, line))
-                sys.exit(1)
-            # TODO - expand this with a regular expression or something
-            if " <" not in github or "@" not in github or ">" not in github:
-                sys.stderr.write("Invalid entry for %r: %r\n" % (username, github))
-                sys.stderr.write("Second column in %s should use the format: name <email>, e.g.\n" % user_table)
-                sys.stderr.write("A.N. Other <a.n.other@example.org>\n")
-                sys.exit(1)
-            user_mapping[username] = github
+    with open(user_table, "r", encoding="utf-8") as handle:
+        lines = handle.read().splitlines()
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            username, github = line.strip().split("\t")
+        except ValueError:
+            sys.stderr.write("Invalid entry in %s: %s\n" % (user_table, line))
+            sys.exit(1)
+        if not _AUTHOR_RE.match(github):
+            sys.stderr.write("Invalid entry for %r: %r\n" % (username, github))
+            sys.stderr.write("Second column in %s should use the format: name <email>, e.g.\n" % user_table)
+            sys.stderr.write("A.N. Other <a.n.other@example.org>\n")
+            sys.exit(1)
+        user_mapping[username] = github
     return user_mapping
 
 
@@ -286,7 +431,8 @@ def check_pandoc(pandoc):
     try:
         child = subprocess.Popen([pandoc, "--version"],
                                  stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
+                                 stderr=subprocess.PIPE,
+                                 encoding="utf-8")
     except OSError:
         sys.exit("Could not find pandoc on $PATH")
     stdout, stderr = child.communicate()
@@ -344,26 +490,24 @@ def cleanup_mediawiki(text):
     # Meanwhile the MediaWiki __TOC__ etc get left in the .md
     # so I'm just going to remove them here.
     #
+    text = text.translate(_ZAP)
+    # TODO - Would benefit from state tracking (for tag mismatches)
+    # Easy case <python> etc, with anything after the tag moved onto a new line
+    text = _LANG_OPEN_RE.sub(lambda m: "<source lang=%s>" % m.group(1).lower()
+                             + ("\n" + m.group(2).rstrip() if m.group(2).strip() else ""), text)
+    # Also cope with <python id=example> etc:
+    text = _LANG_OPEN_ATTR_RE.sub(r"<source lang=\1 ", text)
+    # Want to support <python>print("Hello world")</python>
+    # where open and closing tags are on the same line:
+    text = _LANG_CLOSE_RE.sub(_close_source, text)
+    # Special case fix for any category links, [[:Category: to [[Category%3A
+    # and likewise [[User: to [[User%3A
+    # See https://github.com/jgm/pandoc/issues/2849
+    text = _NAMESPACE_LINK_RE.sub(lambda m: "[[%s%%3A" % (m.group(1) or m.group(2)), text)
+
     new = []
     categories = []
-    languages = ["python", "perl", "sql", "bash", "ruby", "java", "xml"]
     for line in text.split("\n"):
-        # line is already unicode
-        line = line.replace("\xe2\x80\x8e".decode("utf-8"), "")  # LEFT-TO-RIGHT
-        # TODO - Would benefit from state tracking (for tag mismatches)
-        for lang in languages:
-            # Easy case <python> etc
-            if line.lower().startswith("<%s>" % lang):
-                line = (("<source lang=%s\n" % lang) + line[len(lang) + 2:]).strip()
-            # Also cope with <python id=example> etc:
-            elif line.startswith("<%s " % lang) and ">" in line:
-                line = (("<source lang=%s " % lang) + line[len(lang) + 2:]).strip()
-            # Want to support <python>print("Hello world")</python>
-            # where open and closing tags are on the same line:
-            if line.rstrip() == "</%s>" % lang:
-                line = "</source>"
-            elif line.rstrip().endswith("</%s>" % lang):
-                line = line.replace("</%s>" % lang, "\n</source>")
         undiv = un_div(line)
         if undiv in ["__TOC__", "__FORCETOC__", "__NOTOC__"]:
             continue
@@ -373,26 +517,25 @@ def cleanup_mediawiki(text):
             line = undiv
         # Look for any category tag, usually done as a single line:
         if "[[Category:" in line:
-            try:
-                tag = line[line.index("[[Category:") + 11:]
-                tag = tag[:tag.index("]]")]
-                assert ("[[Category:%s]]" % tag) in line, "Inferred %r from %s" % (tag, line)
-                categories.append(tag)
-                line = line.replace("[[Category:%s]]" % tag, "").strip()
-            except (IndexError, ValueError):
-                pass
-            if not line:
-                continue
-        # Special case fix for any category links,
-        # See https://github.com/jgm/pandoc/issues/2849
-        if "[[:Category:" in line:
-            line = line.replace("[[:Category:", "[[Category%3A")
-        if "[[User:" in line:
-            line = line.replace("[[User:", "[[User%3A")
+            tags = _CATEGORY_RE.findall(line)
+            if tags:
+                categories.extend(tags)
+                line = _CATEGORY_RE.sub("", line).strip()
+                if not line:
+                    continue
         new.append(line)
     return "\n".join(new), categories
 
 
+def _close_source(match):
+    """Replace </python> etc on a line ending with one, see cleanup_mediawiki."""
+    if not match.group(1):
+        return "</source>"
+    # Every closing tag for that language on the line gets a line of its own
+    tag = "</%s>" % match.group(2)
+    return match.group(0).replace(tag, "\n</source>")
+
+
 def cleanup_markdown(text, source_url, prefix):
     """Post-process markdown from pandoc before saving it.
 
@@ -416,14 +559,14 @@ def cleanup_markdown(text, source_url, prefix):
     # Looking for ...](URL "wikilink")... where the URL should look
     # like a relative link (no http etc), but may not be, e.g.
     # [DAS/1](DAS/1 "wikilink") --> [DAS/1](/wiki/DAS/1 "wikilink")
-    p = re.compile(']\([A-Z].* "wikilink"\)')
-    for old in p.findall(text):
-        if old.startswith(("](http", "](ftp:", "](mailto:")):
-            continue
-        new = "](/%s%s" % (prefix, old[2:])
-        # print("Replacing %s --> %s" % (old[1:], new[1:]))
-        text = text.replace(old, new)
-    return text
+    def fix_wikilink(match):
+        url = match.group("url")
+        if url.startswith(("http", "ftp:", "mailto:")):
+            return match.group(0)
+        return '](/%s%s "wikilink")' % (prefix, url)
+
+    # One pass over the text, rather than a str.replace per link
+    return _WIKILINK_RE.sub(fix_wikilink, text)
 
 
 def clean_tag(tag):
@@ -439,11 +582,13 @@ def make_canonical(title):
     return title[0].upper() + title[1:].lower()
 
 
+@functools.lru_cache(maxsize=None)
 def make_url(title, prefix):
     """Spaces to underscore; adds prefix; adds trailing slash."""
     return os.path.join(prefix, title.replace(" ", "_") + "/")
 
 
+@functools.lru_cache(maxsize=None)
 def make_filename(title, ext, prefix):
     """Spaces/colons/slahses to underscores; adds extension given.
 
@@ -454,113 +599,238 @@ def make_filename(title, ext, prefix):
     with automatic links when there are child-folders. Again we
     get the desired URL via the YAML header permalink entry.
     """
-    return os.path.join(prefix, title.replace(" ", "_").replace(":", "_").replace("/", "_") + os.path.extsep + ext)
+    # Any prefix will end with a slash (checked in main)
+    return prefix + title.translate(_FILENAME_TRANS) + os.path.extsep + ext
+
+
+def is_wiki_page(title, page_prefixes_to_ignore):
+    """Is this a page to convert to markdown (not a file, template, etc)?"""
+    if ignore_by_prefix(title, page_prefixes_to_ignore):
+        return False
+    return not title.startswith(("File:", "Template:"))
+
+
+def get_redirect(text):
+    """Return target of a #REDIRECT [[...]] page, or None."""
+    match = _REDIRECT_RE.match(text)
+    if match:
+        return match.group(1).translate(_ZAP)
+    return None
 
 
 def ignore_by_prefix(title, page_prefixes_to_ignore):
-    for prefix in page_prefixes_to_ignore:
-        if title.startswith(prefix):
-            return True
-    return False
+    # No copy made when given a tuple, as in main()
+    return title.startswith(tuple(page_prefixes_to_ignore))
 
 
-def dump_revision(mw_filename, md_filename, text, title, args, date):
+def dump_revision(mw_filename, md_filename, text, title, args, date, converted):
     # We may have unicode, e.g. character u'\xed' (accented i)
-    original = text
-    text, categories = cleanup_mediawiki(text)
-
-    if text.strip().startswith("#REDIRECT [[") and text.strip().endswith("]]"):
-        redirect = text.strip()[12:-2]
-        if "\n" not in redirect and "]" not in redirect:
-            # Maybe I should just have written a regular expression?
-            with open(mw_filename, "w") as handle:
-                handle.write(original.encode("utf8"))
-            with open(md_filename, "w") as handle:
-                handle.write("---\n")
-                handle.write("title: %s\n" % safe_for_yaml(title.encode("utf-8")))
-                handle.write("permalink: %s\n" % safe_for_yaml(make_url(title, args.prefix).encode("utf-8")))
-                handle.write("redirect_to: /%s\n" % safe_for_yaml(make_url(redirect, args.prefix).encode("utf-8")))
-                handle.write("date: %s\n" % (date,))
-                handle.write("---\n\n")
-                handle.write("You should automatically be redirected to [%s](/%s)\n"
-                             % (redirect.encode("utf-8"), make_url(redirect, args.prefix).encode("utf-8")))
-            print("Setup redirection %s --> %s" % (title.encode("utf-8"), redirect.encode("utf-8")))
-            return True
-
-    with open(mw_filename, "w") as handle:
-        handle.write(text.encode("utf8"))
-    child = subprocess.Popen([args.pandoc,
-                              "-f", "mediawiki",
-                              "-t", "markdown_github-hard_line_breaks",
-                              mw_filename],
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             )
-    stdout, stderr = child.communicate()
-    # Now over-write with the original mediawiki to record that in git,
-    with open(mw_filename, "w") as handle:
-        handle.write(original.encode("utf8"))
+    # The markdown itself comes from convert_revisions
+    categories, redirect, pandoc_output = converted
+
+    if redirect:
+        with open(mw_filename, "w", encoding="utf-8", newline="\n") as handle:
+            handle.write(text)
+        with open(md_filename, "w", encoding="utf-8", newline="\n") as handle:
+            handle.write("".join([
+                "---\n",
+                "title: %s\n" % safe_for_yaml(title),
+                "permalink: %s\n" % safe_for_yaml(make_url(title, args.prefix)),
+                "redirect_to: /%s\n" % safe_for_yaml(make_url(redirect, args.prefix)),
+                "date: %s\n" % (date,),
+                "---\n\n",
+                "You should automatically be redirected to [%s](/%s)\n" % (redirect, make_url(redirect, args.prefix)),
+            ]))
+        print("Setup redirection %s --> %s" % (title, redirect))
+        return True
+
+    # Record the original mediawiki in git (pandoc was given the cleaned up text)
+    with open(mw_filename, "w", encoding="utf-8", newline="\n") as handle:
+        handle.write(text)
 
     # What did pandoc think?
-    if stderr or child.returncode:
+    stdout, stderr, return_code = pandoc_output
+    if stderr or return_code:
         print(stdout)
     if stderr:
         sys.stderr.write(stderr)
-    if child.returncode:
-        sys.stderr.write("Error %i from pandoc\n" % child.returncode)
+    if return_code:
+        sys.stderr.write("Error %i from pandoc\n" % return_code)
     if not stdout:
         sys.stderr.write("No output from pandoc for %r\n" % mw_filename)
-    if child.returncode or not stdout:
+    if return_code or not stdout:
         return False
-    with open(md_filename, "w") as handle:
-        handle.write("---\n")
-        handle.write("title: %s\n" % safe_for_yaml(title.encode("utf-8")))
-        handle.write("permalink: %s\n" % safe_for_yaml(make_url(title, args.prefix).encode("utf-8")))
-        handle.write("date: %s\n" % (date,))
-        if title.startswith("Category:"):
-            # This assumes have layout template called tagpage
-            # which will insert the tag listing automatically
-            # i.e. Behaves like MediaWiki for Category:XXX
-            # where we mapped XXX as a tag in Jekyll
-            handle.write("layout: tagpage\n")
-            handle.write("tag: %s\n" % title[9:])
-        else:
-            # Note a category page,
-            if args.default_layout:
-                handle.write("layout: {0}\n".format(args.default_layout))
-            if categories:
-                # Map them to Jekyll tags as can have more than one per page:
-                handle.write("tags:\n")
-                for category in categories:
-                    handle.write(" - {0}\n".format(category))
-        handle.write("---\n\n")
-        handle.write(cleanup_markdown(stdout, make_url(title, args.prefix), args.prefix))
+    # Build up the YAML header and markdown, then write it all at once
+    parts = ["---\n",
+             "title: %s\n" % safe_for_yaml(title),
+             "permalink: %s\n" % safe_for_yaml(make_url(title, args.prefix)),
+             "date: %s\n" % (date,)]
+    if title.startswith("Category:"):
+        # This assumes have layout template called tagpage
+        # which will insert the tag listing automatically
+        # i.e. Behaves like MediaWiki for Category:XXX
+        # where we mapped XXX as a tag in Jekyll
+        parts.append("layout: tagpage\n")
+        parts.append("tag: %s\n" % title[9:])
+    else:
+        # Note a category page,
+        if args.default_layout:
+            parts.append("layout: {0}\n".format(args.default_layout))
+        if categories:
+            # Map them to Jekyll tags as can have more than one per page:
+            parts.append("tags:\n")
+            parts.extend(" - {0}\n".format(category) for category in categories)
+    parts.append("---\n\n")
+    parts.append(cleanup_markdown(stdout, make_url(title, args.prefix), args.prefix))
+    with open(md_filename, "w", encoding="utf-8", newline="\n") as handle:
+        handle.write("".join(parts))
     return True
 
 
-def run(cmd_string):
-    return_code = os.system(cmd_string)
+def run_pandoc(pandoc, text):
+    """Convert mediawiki text to markdown via pandoc's stdin/stdout.
+
+    Returns tuple: stdout, stderr, return code
+    """
+    child = subprocess.Popen([pandoc,
+                              "-f", "mediawiki",
+                              "-t", "markdown_github-hard_line_breaks"],
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             encoding="utf-8",
+                             )
+    stdout, stderr = child.communicate(text)
+    return stdout, _PANDOC_NOISE_RE.sub("", stderr), child.returncode
+
+
+def run_pandoc_batch(pandoc, texts):
+    """Convert a list of mediawiki texts to markdown, mostly in one go.
+
+    Starting pandoc is relatively slow, so the texts are joined with a
+    sentinel paragraph between them, converted together, and the output
+    split on the sentinel again. If that goes wrong (a pandoc error, or an
+    unclosed tag eating the sentinel) it falls back on one pandoc call per
+    text. Any pandoc warnings from a good batch are reported once for the
+    whole batch, rather than against each page.
+
+    Pages with footnotes (or the sentinel itself) are converted on their
+    own, as pandoc would collect all the notes together at the end of the
+    combined output.
+
+    Returns list of tuples: stdout, stderr, return code
+    """
+    results = [None] * len(texts)
+    batchable = [i for i, text in enumerate(texts) if PANDOC_SENTINEL not in text and "<ref" not in text]
+    if len(batchable) > 1:
+        separator = "\n\n%s\n\n" % PANDOC_SENTINEL
+        stdout, stderr, return_code = run_pandoc(pandoc, separator.join(texts[i] for i in batchable))
+        parts = stdout.split(separator)
+        if not return_code and len(parts) == len(batchable) and all(parts):
+            if stderr:
+                sys.stderr.write("Warnings from pandoc for a batch of %i pages:\n" % len(batchable))
+                sys.stderr.write(stderr)
+            # Separator ate the final newline of all but the last document
+            parts = [part + "\n" for part in parts[:-1]] + [parts[-1]]
+            for i, part in zip(batchable, parts):
+                results[i] = (part, "", 0)
+    return [result or run_pandoc(pandoc, text) for result, text in zip(results, texts)]
+
+
+def run(cmd):
+    # No shell involved, so no need to quote the arguments,
+    # but that also means no shell to report a missing binary:
+    try:
+        return_code = subprocess.run(cmd).returncode
+    except OSError:
+        sys.exit("Could not run %s, is it on $PATH?" % cmd[0])
     if return_code:
-        sys.stderr.write("Error %i from: %s\n" % (return_code, cmd_string))
+        sys.stderr.write("Error %i from: %r\n" % (return_code, cmd))
         sys.exit(return_code)
 
 
-def commit_revision(mw_filename, md_filename, username, date, comment, user_mapping, args, missing_users):
+def check_git(git):
+    """Check we can commit to the current git branch.
+
+    Returns tuple: branch ref, committer identity, does the branch exist yet
+    """
+    try:
+        ref = subprocess.check_output([git, "symbolic-ref", "-q", "HEAD"], encoding="utf-8").strip()
+    except OSError:
+        # First time we try to run git
+        sys.exit("Could not run %s, is it on $PATH?" % git)
+    except subprocess.CalledProcessError:
+        sys.exit("Expected to be on a Git branch, not a detached HEAD!")
+    try:
+        # As would be used by git commit, includes current time and timezone
+        committer = subprocess.check_output([git, "var", "GIT_COMMITTER_IDENT"], encoding="utf-8").strip()
+    except subprocess.CalledProcessError as err:
+        sys.exit("Return code %i from git var GIT_COMMITTER_IDENT, is your git user.name and user.email set?"
+                 % err.returncode)
+    with open(os.devnull, "w") as null:
+        exists = not subprocess.call([git, "rev-parse", "-q", "--verify", ref], stdout=null)
+    return ref, committer, exists
+
+
+def start_fast_import(args, branch):
+    """Start a git fast-import process to commit all the revisions.
+
+    Rather than a git add and git commit per revision, all the commits
+    are streamed to a single git fast-import adding them onto the current
+    branch (as returned by check_git). Returns a dict used to track this in
+    commit_files, including the pending commit (if any) still collecting
+    files, see commit_files.
+    """
+    ref, committer, exists = branch
+    child = subprocess.Popen([args.git, "fast-import", "--quiet", "--date-format=raw"],
+                             stdin=subprocess.PIPE)
+    return {"child": child,
+            "ref": ref,
+            "committer": committer,
+            # fast-import needs telling to build on an existing branch:
+            "from": ref + "^0" if exists else None,
+            "pending": None}
+
+
+def finish_fast_import(importer, args):
+    write_pending_commit(importer)
+    child = importer["child"]
+    child.stdin.close()
+    child.wait()
+    if child.returncode:
+        sys.stderr.write("Return code %i from git fast-import\n" % child.returncode)
+        sys.exit(child.returncode)
+    # The branch has moved on underneath the index and working tree,
+    # which may also still hold any revisions we skipped:
+    run([args.git, "reset", "--hard"])
+
+
+def git_date(date):
+    """Turn MediaWiki timestamp (UTC) into git's raw date format."""
+    return "%i +0000" % calendar.timegm(time.strptime(date, "%Y-%m-%dT%H:%M:%SZ"))
+
+
+def fast_import_path(filename):
+    """Quote filename for git fast-import if required."""
+    if filename.startswith('"') or "\n" in filename:
+        return '"%s"' % filename.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return filename
+
+
+def commit_revision(mw_filename, md_filename, username, date, comment, user_mapping, args, missing_users,
+                    importer):
     assert os.path.isfile(md_filename), md_filename
     assert os.path.isfile(mw_filename), mw_filename
     if not comment:
         comment = "Change to wiki page"
-    return commit_files([md_filename, mw_filename], username, date, comment, user_mapping, args, missing_users)
+    return commit_files([md_filename, mw_filename], username, date, comment, user_mapping, args, missing_users,
+                        importer)
 
 
-def commit_files(filenames, username, date, comment, user_mapping, args, missing_users):
+def commit_files(filenames, username, date, comment, user_mapping, args, missing_users, importer):
     assert filenames, "Nothing to commit: %r" % filenames
     for f in filenames:
         assert os.path.isfile(f), f
-    # do we need to escape anything other than double-quote here?
-    cmd = '"{0}" add "{1}"'.format(args.git,
-                                   '" "'.join(map(lambda x: x.replace('"', '\\"').encode('utf-8'), filenames)))
-    run(cmd)
     # TODO - how to detect and skip empty commit?
     if username in user_mapping:
         author = user_mapping[username]
@@ -575,34 +845,51 @@ def commit_files(filenames, username, date, comment, user_mapping, args, missing
         author = "Anonymous Contributor <{0}>".format(args.default_email)
     if not comment:
         comment = "No comment"
-    # In order to handle quotes etc in the message, rather than -m "%s"
-    # using the -F option and piping to stdin.
-    # cmd = '"%s" commit "%s" --date "%s" --author "%s" -m "%s" --allow-empty' \
-    #       % (git, filename, date, author, comment)
-    cmd = [args.git, 'commit'] + filenames + [
-                              '--date', date,
-                              '--author', author,
-                              '-F', '-',
-                              '--allow-empty']
-    child = subprocess.Popen(cmd,
-                             stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE
-                             )
-    child.stdin.write(comment.encode("utf8"))
-    stdout, stderr = child.communicate()
-    if child.returncode or stderr:
-        sys.stderr.write(stdout)
-    if stderr:
-        sys.stderr.write(stderr)
-    if child.returncode:
-        sys.stderr.write("Return code %i from git commit\n" % child.returncode)
-        sys.stderr.write("Popen(%r, ...)\n" % cmd)
-        sys.exit(child.returncode)
+    # Successive revisions by the same user with the same timestamp become
+    # a single commit, so hold on to this one until we see the next.
+    pending = importer["pending"]
+    if pending and pending["key"] != (date, username):
+        write_pending_commit(importer)
+        pending = None
+    if not pending:
+        pending = importer["pending"] = {"key": (date, username),
+                                         "author": author,
+                                         "comments": [],
+                                         "files": dict()}
+    if comment not in pending["comments"]:
+        pending["comments"].append(comment)
+    for filename in filenames:
+        # Read it now, as may be overwritten before the commit is written
+        with open(filename, "rb") as handle:
+            pending["files"][filename] = handle.read()
     return missing_users
 
 
-def commit_file(title, filename, date, username, contents, comment, user_mapping, args, missing_users):
+def write_pending_commit(importer):
+    pending = importer["pending"]
+    if not pending:
+        return
+    importer["pending"] = None
+    date, username = pending["key"]
+    # The data command takes an exact byte count, so no need to escape
+    # quotes etc in the message. This is the one place we need bytes.
+    # Blank lines between comments, so git log only takes the first as the subject
+    message = "\n\n".join(pending["comments"]).encode("utf8")
+    stream = importer["child"].stdin
+    stream.write(("commit %s\nauthor %s %s\ncommitter %s\ndata %i\n"
+                  % (importer["ref"], pending["author"], git_date(date), importer["committer"], len(message))
+                  ).encode("utf8"))
+    stream.write(message + b"\n")
+    if importer["from"]:
+        stream.write(("from %s\n" % importer["from"]).encode("utf8"))
+        importer["from"] = None
+    for filename, contents in pending["files"].items():
+        stream.write(("M 100644 inline %s\ndata %i\n" % (fast_import_path(filename), len(contents))).encode("utf8"))
+        stream.write(contents + b"\n")
+    stream.write(b"\n")
+
+
+def commit_file(title, filename, date, username, contents, comment, user_mapping, args, missing_users, importer):
     # commit an image or other file from its base64 encoded representation
     assert title.startswith("File:")
     if not filename:
@@ -610,7 +897,7 @@ def commit_file(title, filename, date, username, contents, comment, user_mapping
     print("Committing %s as of upload %s by %s" % (filename, date, username))
     with open(filename, "wb") as handle:
         handle.write(base64.b64decode(contents))
-    return commit_files([filename], username, date, comment, user_mapping, args, missing_users)
+    return commit_files([filename], username, date, comment, user_mapping, args, missing_users, importer)
 
 
 def safe_for_yaml(val):
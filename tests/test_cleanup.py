@@ -0,0 +1,43 @@
+from convert import cleanup_mediawiki, cleanup_markdown, get_redirect, un_div
+
+PEAR = \
+    '<div style="float:left; maxwidth: 180px; margin-left:25px; margin-right:15px; background-color: #FFFFFF">' \
+    '[[Image:Pear.png|left|The Bosc Pear]]</div>'
+
+
+def test_un_div_strips_wrapping():
+    assert un_div(PEAR) == '[[Image:Pear.png|left|The Bosc Pear]]'
+
+
+def test_cleanup_mediawiki_undiv_image():
+    assert cleanup_mediawiki(PEAR) == ('[[Image:Pear.png|left|The Bosc Pear]]', [])
+
+
+def test_cleanup_mediawiki_language_tags():
+    text = '<python>\nimport antigravity\n</python>\n<perl id=example>print 1;</perl>'
+    assert cleanup_mediawiki(text) == (
+        '<source lang=python>\nimport antigravity\n</source>\n<source lang=perl id=example>print 1;\n</source>', [])
+    assert cleanup_mediawiki('a </python> b </python>') == ('a \n</source> b \n</source>', [])
+    # Only lines ending with a closing tag are changed
+    assert cleanup_mediawiki('a </python> b') == ('a </python> b', [])
+
+
+def test_cleanup_mediawiki_categories():
+    text = 'Some text\u200e\n[[Category:Tutorial]] [[Category:Python]]\n__TOC__\nSee [[:Category:Tutorial]]'
+    assert cleanup_mediawiki(text) == ('Some text\nSee [[Category%3ATutorial]]', ['Tutorial', 'Python'])
+
+
+def test_cleanup_markdown_wikilinks():
+    text = '[DAS/1](DAS/1 "wikilink") and [Home](Main_Page "wikilink")\n'
+    assert cleanup_markdown(text, 'wiki/DAS/2/', 'wiki/') == \
+        '[DAS/1](/wiki/DAS/1 "wikilink") and [Home](/wiki/Main_Page "wikilink")\n'
+    text = '[Foo (bar)](Foo_(bar) "wikilink")\n'
+    assert cleanup_markdown(text, 'wiki/DAS/2/', 'wiki/') == '[Foo (bar)](/wiki/Foo_(bar) "wikilink")\n'
+
+
+def test_get_redirect():
+    assert get_redirect('#REDIRECT [[Main Page]]\n') == 'Main Page'
+    assert get_redirect('#REDIRECT [[Main Page]]\nPlus some text') is None
+    assert get_redirect('Not a [[Redirect]]') is None
+    assert get_redirect('#REDIRECT [[Main Page]]\n[[Category:Redirects]]\n\n') == 'Main Page'
+    assert get_redirect('#REDIRECT [[Main Page]] [[Category:Redirects]]') == 'Main Page'
@@ -0,0 +1,68 @@
+import argparse
+import shutil
+import subprocess
+
+import pytest
+
+from convert import check_git, commit_files, fast_import_path, finish_fast_import, git_date, start_fast_import
+
+def test_git_date():
+    assert git_date("2008-01-02T03:04:05Z") == "1199243045 +0000"
+
+
+def test_fast_import_path():
+    assert fast_import_path("wiki/Main_Page.md") == "wiki/Main_Page.md"
+    assert fast_import_path('"Quoted".md') == '"\\"Quoted\\".md"'
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    if shutil.which("git") is None:
+        pytest.skip("git not on $PATH")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("GIT_COMMITTER_NAME", "Converter")
+    monkeypatch.setenv("GIT_COMMITTER_EMAIL", "converter@example.org")
+    subprocess.check_call(["git", "init", "-q"])
+    subprocess.check_call(["git", "commit", "-q", "--allow-empty", "-m", "Existing commit",
+                           "--author", "Converter <converter@example.org>",
+                           "--date", "1199059200 +0000"])
+    return tmp_path
+
+
+def write(filename, text):
+    with open(filename, "w") as handle:
+        handle.write(text)
+
+
+def test_commits_via_fast_import(repo):
+    args = argparse.Namespace(git="git", default_email="anon@example.org")
+    user_mapping = {"Alice": "Alice A <alice@example.org>"}
+    importer = start_fast_import(args, check_git(args.git))
+    write("A.md", "one\n")
+    missing = commit_files(["A.md"], "Alice", "2008-01-01T00:00:00Z", "First", user_mapping, args, {}, importer)
+    # Same user and timestamp, so goes in the same commit
+    write("B.md", "two\n")
+    missing = commit_files(["B.md"], "Alice", "2008-01-01T00:00:00Z", "Second", user_mapping, args, missing,
+                           importer)
+    write("A.md", "three\n")
+    missing = commit_files(["A.md"], "Bob", "2008-01-02T00:00:00Z", "", user_mapping, args, missing, importer)
+    write("A.md", "four\n")
+    missing = commit_files(["A.md"], "", "2008-01-03T00:00:00Z", "Anon", user_mapping, args, missing, importer)
+    finish_fast_import(importer, args)
+    assert missing == {"Bob": 1}
+
+    log = subprocess.check_output(["git", "log", "--format=%an <%ae>|%ad|%B%x00", "--date=raw"],
+                                  encoding="utf-8").split("\x00")
+    assert [entry.strip() for entry in log][:-1] == [
+        "Anonymous Contributor <anon@example.org>|1199318400 +0000|Anon",
+        "Bob <anon@example.org>|1199232000 +0000|No comment",
+        "Alice A <alice@example.org>|1199145600 +0000|First\n\nSecond",
+        # Built on top of the existing branch
+        "Converter <converter@example.org>|1199059200 +0000|Existing commit",
+    ]
+    # Only the first merged comment is the subject line
+    assert subprocess.check_output(["git", "log", "-1", "--format=%s", "HEAD~2"], encoding="utf-8") == "First\n"
+    assert subprocess.check_output(["git", "show", "HEAD~2:A.md"], encoding="utf-8") == "one\n"
+    assert subprocess.check_output(["git", "show", "HEAD~2:B.md"], encoding="utf-8") == "two\n"
+    # Working tree matches the last commit
+    assert subprocess.check_output(["git", "status", "--porcelain"], encoding="utf-8") == ""
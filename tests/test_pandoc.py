@@ -0,0 +1,73 @@
+import os
+import stat
+import sys
+
+import pytest
+
+from convert import PANDOC_SENTINEL, run_pandoc_batch
+
+# Stand-in for pandoc, echoes stdin back with pandoc-like trailing newline,
+# always warns markdown_github is deprecated (as real pandoc does), warns
+# about any text containing WARN, fails on any text containing FAIL, and
+# logs each call to calls.log
+STUB = '''#!%s
+import os
+import sys
+text = sys.stdin.read().strip("\\n") + "\\n"
+with open(os.path.join(os.path.dirname(__file__), "calls.log"), "a") as handle:
+    handle.write(text.replace("\\n", " ") + "\\n")
+sys.stderr.write("[WARNING] Deprecated: markdown_github. Use gfm instead.\\n")
+if "WARN" in text:
+    sys.stderr.write("warning\\n")
+if "FAIL" in text:
+    sys.exit(1)
+sys.stdout.write(text)
+'''
+
+
+@pytest.fixture
+def pandoc(tmp_path):
+    path = tmp_path / "pandoc"
+    path.write_text(STUB % sys.executable)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+def calls(pandoc):
+    with open(os.path.join(os.path.dirname(pandoc), "calls.log")) as handle:
+        return handle.read().splitlines()
+
+
+def test_batch_splits_on_sentinel(pandoc):
+    results = run_pandoc_batch(pandoc, ["one", "two", "three"])
+    assert results == [("one\n", "", 0), ("two\n", "", 0), ("three\n", "", 0)]
+    assert len(calls(pandoc)) == 1
+    assert PANDOC_SENTINEL in calls(pandoc)[0]
+
+
+def test_batch_converts_footnotes_alone(pandoc):
+    results = run_pandoc_batch(pandoc, ["one", "two<ref>note</ref>", "three"])
+    assert results == [("one\n", "", 0), ("two<ref>note</ref>\n", "", 0), ("three\n", "", 0)]
+    # One call for the batch, one for the page with the footnote
+    assert len(calls(pandoc)) == 2
+
+
+def test_batch_ignores_deprecation_warning(pandoc, capsys):
+    results = run_pandoc_batch(pandoc, ["one %i" % i for i in range(50)])
+    assert results == [("one %i\n" % i, "", 0) for i in range(50)]
+    assert len(calls(pandoc)) == 1
+    assert capsys.readouterr().err == ""
+
+
+def test_batch_reports_warnings_once(pandoc, capsys):
+    results = run_pandoc_batch(pandoc, ["one", "WARN two", "three"])
+    assert results == [("one\n", "", 0), ("WARN two\n", "", 0), ("three\n", "", 0)]
+    assert len(calls(pandoc)) == 1
+    assert capsys.readouterr().err == "Warnings from pandoc for a batch of 3 pages:\nwarning\n"
+
+
+def test_batch_falls_back_on_error(pandoc):
+    results = run_pandoc_batch(pandoc, ["one", "FAIL two", "three"])
+    assert results == [("one\n", "", 0), ("", "", 1), ("three\n", "", 0)]
+    # Failed batch, then one call per page
+    assert len(calls(pandoc)) == 4